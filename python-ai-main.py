@@ -2,36 +2,71 @@
 # src/main.py
 
 import asyncio
-import json
 import logging
 import os
 import time
+from dataclasses import asdict, dataclass
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 import uvicorn
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 import redis.asyncio as redis
+import orjson
 import numpy as np
+from cachetools import LRUCache
 from transformers import (
     AutoTokenizer, AutoModelForSequenceClassification,
     AutoModelForTokenClassification, pipeline
 )
 import spacy
+import ahocorasick
+import re2
 import hashlib
+import shutil
 from collections import defaultdict
 
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    import onnxruntime
+    from optimum.onnxruntime import (
+        ORTModelForSequenceClassification, ORTModelForTokenClassification, ORTQuantizer
+    )
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:
+    onnxruntime = None
+    ORTModelForSequenceClassification = ORTModelForTokenClassification = ORTQuantizer = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load spaCy model for NLP
+# Load spaCy model for NLP; only the NER component (and its tok2vec) is used
 try:
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load(
+        "en_core_web_sm",
+        disable=["parser", "tagger", "lemmatizer", "attribute_ruler"]
+    )
 except OSError:
     logger.warning("spaCy model not found. Install with: python -m spacy download en_core_web_sm")
     nlp = None
 
+# Lightweight sentence splitter used to chunk long texts before inference
+sentencizer = spacy.blank("en")
+sentencizer.add_pipe("sentencizer")
+sentencizer.max_length = 10_000_000  # Only tokenizes, so large scraped blobs are fine
+
 class AnalysisRequest(BaseModel):
     job_id: str
     job_type: str
@@ -43,6 +78,8 @@ class ExtractedEntity(BaseModel):
     type: str
     value: str
     confidence: float
+    start: Optional[int] = None
+    end: Optional[int] = None
 
 class IndicatorOfCompromise(BaseModel):
     type: str
@@ -52,6 +89,56 @@ class IndicatorOfCompromise(BaseModel):
     first_seen: datetime
     last_seen: datetime
 
+# Internal records used on the hot path; validated models are only built
+# once per response in analyze_content
+@dataclass(slots=True)
+class _Entity:
+    type: str
+    value: str
+    confidence: float
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+@dataclass(slots=True)
+class _IOC:
+    type: str
+    value: str
+    confidence: float
+    threat_type: str
+    first_seen: datetime
+    last_seen: datetime
+    seen_iso: str  # Pre-serialized first/last seen for Redis; dropped by model_construct
+
+# Compiled eagerly at import from the explicit signature, so the first request
+# doesn't pay for JIT compilation; no on-disk cache since the pod's root
+# filesystem is read-only
+@njit("float64[:](uint8[:], uint32[:], boolean[:], boolean[:], float64[:], int64)")
+def score_iocs(type_ids, ip_addrs, ip_valid, suspicious, base_confidence, ip_type_id):
+    """Compute confidence per IOC match from type lookup tables"""
+    confidence = np.empty(type_ids.shape[0], dtype=np.float64)
+    
+    for i in range(type_ids.shape[0]):
+        type_id = type_ids[i]
+        confidence[i] = base_confidence[type_id]
+        
+        if type_id == ip_type_id:
+            if not ip_valid[i]:
+                confidence[i] = 0.0  # Octet above 255, not an address
+                continue
+            ip = ip_addrs[i]
+            private = (
+                ((ip & 0xFF000000) == 0x0A000000) |  # 10.0.0.0/8
+                ((ip & 0xFFF00000) == 0xAC100000) |  # 172.16.0.0/12
+                ((ip & 0xFFFF0000) == 0xC0A80000) |  # 192.168.0.0/16
+                ((ip & 0xFF000000) == 0x7F000000)    # 127.0.0.0/8
+            )
+            if private:
+                confidence[i] = 0.3
+        elif suspicious[i]:
+            confidence[i] = 0.9  # Suspicious TLDs, on a domain or a URL/email containing one
+    
+    return confidence
+
 class AIAnalysisResult(BaseModel):
     threat_level: str
     entities: List[ExtractedEntity]
@@ -60,12 +147,97 @@ class AIAnalysisResult(BaseModel):
     iocs: List[IndicatorOfCompromise]
     related_campaigns: List[str]
 
+class BatchedPipeline:
+    """Coalesce concurrent single-text pipeline calls into batched forward passes"""
+
+    def __init__(self, pipe, max_batch_size: int = 32, max_delay: float = 0.01, **call_kwargs):
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.call_kwargs = call_kwargs
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    async def submit(self, text: str) -> Any:
+        """Queue text for the next batch and wait for its result"""
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self):
+        """Background task that drains the queue into batches"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self.queue.get()]
+            
+            # Wait up to max_delay for more requests to fill the batch
+            try:
+                async with asyncio.timeout_at(loop.time() + self.max_delay):
+                    while len(batch) < self.max_batch_size:
+                        batch.append(await self.queue.get())
+            except TimeoutError:
+                pass
+            
+            try:
+                results = await self.infer([text for text, _ in batch])
+            except Exception as e:
+                # Retry one at a time so a bad input only fails its own request
+                logger.warning(f"Batch of {len(batch)} failed, retrying individually: {e}")
+                for text, future in batch:
+                    try:
+                        result = (await self.infer([text]))[0]
+                    except Exception as item_error:
+                        if not future.done():
+                            future.set_exception(item_error)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def infer(self, texts: List[str]) -> List[Any]:
+        """Run the pipeline on texts off the event loop, one result per input"""
+        results = await asyncio.to_thread(
+            self.pipe, texts, batch_size=self.max_batch_size, **self.call_kwargs
+        )
+        if len(results) != len(texts):
+            raise RuntimeError(f"Pipeline returned {len(results)} results for {len(texts)} inputs")
+        return results
+
 class ThreatIntelligenceEngine:
     def __init__(self):
         self.models = {}
+        self.batchers = {}
+        self.redis = None  # Shared client, assigned at app startup
+        self.inference_cache = LRUCache(maxsize=int(os.getenv('INFERENCE_CACHE_SIZE', '4096')))
+        self.inference_cache_ttl = int(os.getenv('INFERENCE_CACHE_TTL', '86400'))
         self.ioc_database = defaultdict(list)
         self.campaign_signatures = {}
         self.threat_patterns = {}
+        
+        # Serve ONNX models from GPU when the CUDA execution provider is available
+        self.use_gpu = (
+            onnxruntime is not None
+            and os.getenv('ONNX_DEVICE', 'auto') != 'cpu'
+            and 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+        )
+        # ONNX Runtime's dynamic INT8 kernels are CPU-only, so GPUs run the FP32 export
+        if ORTQuantizer is None:
+            self.model_variant = 'fp32'
+        else:
+            self.model_variant = 'onnx' if self.use_gpu else 'onnx-int8'
+        self.model_ids = {
+            'sentiment': "cardiffnlp/twitter-roberta-base-sentiment-latest",
+            'ner': "dbmdz/bert-large-cased-finetuned-conll03-english",
+            'threat_classifier': "martin-ha/toxic-comment-model",
+        }
         self.setup_models()
         self.load_threat_intelligence()
 
@@ -73,38 +245,103 @@ class ThreatIntelligenceEngine:
         """Initialize AI/ML models for analysis"""
         try:
             # Sentiment analysis model
-            self.models['sentiment'] = pipeline(
+            self.models['sentiment'] = self.load_pipeline(
                 "sentiment-analysis",
-                model="cardiffnlp/twitter-roberta-base-sentiment-latest",
+                self.model_ids['sentiment'],
+                ORTModelForSequenceClassification,
                 return_all_scores=True
             )
             
             # Named Entity Recognition model
-            self.models['ner'] = pipeline(
+            self.models['ner'] = self.load_pipeline(
                 "ner",
-                model="dbmdz/bert-large-cased-finetuned-conll03-english",
+                self.model_ids['ner'],
+                ORTModelForTokenClassification,
                 aggregation_strategy="simple"
             )
             
             # Threat classification model (using general classification for demo)
-            self.models['threat_classifier'] = pipeline(
+            self.models['threat_classifier'] = self.load_pipeline(
                 "text-classification",
-                model="martin-ha/toxic-comment-model",
+                self.model_ids['threat_classifier'],
+                ORTModelForSequenceClassification,
                 return_all_scores=True
             )
             
+            # Micro-batch concurrent requests into one forward pass per model
+            self.batchers = {
+                'sentiment': BatchedPipeline(self.models['sentiment'], truncation=True),
+                'ner': BatchedPipeline(self.models['ner']),
+                'threat_classifier': BatchedPipeline(self.models['threat_classifier'], truncation=True),
+            }
+            
             logger.info("AI models loaded successfully")
             
         except Exception as e:
             logger.error(f"Error loading AI models: {e}")
             self.models = {}
+            self.batchers = {}
+
+    def load_pipeline(self, task: str, model_id: str, ort_model_class, **kwargs):
+        """Load a pipeline backed by an ONNX export of the model (INT8-quantized on CPU)"""
+        if ORTQuantizer is None:
+            logger.warning(f"optimum[onnxruntime] not installed, loading {model_id} in FP32")
+            return pipeline(task, model=model_id, **kwargs)
+        
+        model_file = 'model.onnx' if self.use_gpu else 'model_quantized.onnx'
+        model_dir = os.path.join(
+            os.getenv('MODEL_CACHE_DIR', 'models'), self.model_variant, model_id.replace('/', '--')
+        )
+        
+        # Artifacts are cached on disk so cold starts skip export + quantization
+        if not os.path.exists(os.path.join(model_dir, model_file)):
+            self.export_onnx_model(model_id, ort_model_class, model_dir, quantize=not self.use_gpu)
+        
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        
+        if self.use_gpu:
+            # IO binding keeps inputs and outputs on the device between calls
+            ort_model = ort_model_class.from_pretrained(
+                model_dir,
+                file_name=model_file,
+                provider="CUDAExecutionProvider",
+                provider_options={"device_id": 0},
+                use_io_binding=True
+            )
+            return pipeline(task, model=ort_model, tokenizer=tokenizer, device="cuda:0", **kwargs)
+        
+        ort_model = ort_model_class.from_pretrained(model_dir, file_name=model_file)
+        return pipeline(task, model=ort_model, tokenizer=tokenizer, **kwargs)
+
+    def export_onnx_model(self, model_id: str, ort_model_class, model_dir: str, quantize: bool):
+        """Export a checkpoint to ONNX, optionally with INT8 dynamic quantization"""
+        logger.info(f"Exporting {model_id} to ONNX{' with INT8 dynamic quantization' if quantize else ''}")
+        build_dir = f"{model_dir}.tmp-{os.getpid()}"
+        ort_model = ort_model_class.from_pretrained(model_id, export=True)
+        
+        if quantize:
+            quantizer = ORTQuantizer.from_pretrained(ort_model)
+            quantizer.quantize(
+                save_dir=build_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            )
+        else:
+            ort_model.save_pretrained(build_dir)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(build_dir)
+        
+        # Publish atomically; another worker may have finished first
+        try:
+            os.rename(build_dir, model_dir)
+        except OSError:
+            shutil.rmtree(build_dir, ignore_errors=True)
 
     def load_threat_intelligence(self):
         """Load threat intelligence data and IOC patterns"""
         # IOC patterns for detection
         self.ioc_patterns = {
             'ip': r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b',
-            'domain': r'\b[a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?(\.[a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?)*\b',
+            # Dot-terminated labels followed by an alphabetic TLD
+            'domain': r'(?i)\b(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}\b',
             'email': r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
             'hash_md5': r'\b[a-fA-F0-9]{32}\b',
             'hash_sha1': r'\b[a-fA-F0-9]{40}\b',
@@ -113,6 +350,41 @@ class ThreatIntelligenceEngine:
             'cve': r'CVE-\d{4}-\d{4,}',
         }
         
+        # Overlapping IOC types; a match inside a higher-ranked match is redundant
+        self.ioc_overlap_priority = {'url': 2, 'email': 1, 'domain': 0}
+        
+        # Hyperscan reports every end offset of an open-ended tail, i.e. one
+        # Python callback per byte of a long URL; re2 reports each match once
+        self.ioc_regex_only = {'url', 'cve'}
+        self.compile_ioc_patterns()
+        
+        # IOC scoring tables
+        self.ioc_base_confidence = {
+            'ip': 0.8,
+            'domain': 0.7,
+            'email': 0.7,
+            'hash_md5': 0.95,
+            'hash_sha1': 0.95,
+            'hash_sha256': 0.95,
+            'url': 0.7,
+            'cve': 0.9,
+        }
+        self.ioc_threat_types = {
+            'hash_md5': 'malware',
+            'hash_sha1': 'malware',
+            'hash_sha256': 'malware',
+            'ip': 'network',
+            'domain': 'network',
+            'url': 'network',
+            'email': 'phishing',
+            'cve': 'vulnerability'
+        }
+        self.suspicious_tlds = ('.tk', '.ml', '.ga')
+        self.ioc_confidence_table = np.array(
+            [self.ioc_base_confidence[ioc_type] for ioc_type in self.ioc_type_table],
+            dtype=np.float64
+        )
+        
         # Known threat actor signatures
         self.campaign_signatures = {
             'apt29': ['cozy bear', 'the dukes', 'minidionis', 'cozyduke'],
@@ -128,117 +400,237 @@ class ThreatIntelligenceEngine:
             'medium': ['suspicious', 'anomaly', 'unusual', 'unauthorized'],
             'low': ['informational', 'advisory', 'warning']
         }
+        self.threat_keyword_scores = {'critical': 10, 'high': 7, 'medium': 4, 'low': 1}
+        
+        # One Aho-Corasick automaton finds campaign signatures and threat keywords
+        # in a single pass; each word maps to the (kind, value) tags it stands for
+        tagged_words = defaultdict(list)
+        for campaign, signatures in self.campaign_signatures.items():
+            for signature in signatures:
+                tagged_words[signature.lower()].append(('campaign', campaign))
+        for level, keywords in self.threat_keywords.items():
+            for keyword in keywords:
+                tagged_words[keyword.lower()].append(('keyword', (level, keyword)))
+        
+        self._signature_ac = ahocorasick.Automaton()
+        for word, tags in tagged_words.items():
+            self._signature_ac.add_word(word, tags)
+        self._signature_ac.make_automaton()
 
-    async def analyze_content(self, request: AnalysisRequest) -> AIAnalysisResult:
-        """Main analysis function that processes scraped content"""
+    async def analyze_content(self, request: AnalysisRequest) -> bytes:
+        """Main analysis function that processes scraped content, returning the JSON payload"""
         logger.info(f"Starting AI analysis for job {request.job_id}")
         
         # Extract text content from results
         text_content = self.extract_text_content(request.results)
-        
-        # Perform various analyses
-        entities = await self.extract_entities(text_content)
-        sentiment = await self.analyze_sentiment(text_content)
-        classification = await self.classify_threat(text_content)
-        iocs = await self.extract_iocs(text_content)
-        threat_level = await self.assess_threat_level(text_content, entities, iocs)
-        campaigns = await self.identify_campaigns(text_content, entities)
+        text_lower = text_content.lower()
+        campaign_matches, keyword_matches = self.match_signatures(text_lower)
+        chunks = self.chunk_text(text_content)
+        
+        # Perform independent analyses concurrently; IOC extraction runs on the
+        # event loop while the models run in worker threads
+        entities, sentiment, classification, iocs = await asyncio.gather(
+            self.extract_entities(chunks),
+            self.analyze_sentiment(chunks),
+            self.classify_threat(chunks),
+            self.extract_iocs(text_content)
+        )
+        threat_level = await self.assess_threat_level(keyword_matches, entities, iocs)
+        campaigns = await self.identify_campaigns(campaign_matches, entities)
         
         result = AIAnalysisResult(
             threat_level=threat_level,
-            entities=entities,
+            entities=[ExtractedEntity.model_construct(**asdict(entity)) for entity in entities],
             sentiment=sentiment,
             classification=classification,
-            iocs=iocs,
+            iocs=[IndicatorOfCompromise.model_construct(**asdict(ioc)) for ioc in iocs],
             related_campaigns=campaigns
         )
         
+        # Serialize once; the same bytes are stored and returned to the client
+        payload = orjson.dumps(result.model_dump())
+        
         # Store analysis results for future correlation
-        await self.store_analysis_results(request.job_id, result)
+        await self.store_analysis_results(request.job_id, payload, iocs)
         
         logger.info(f"AI analysis completed for job {request.job_id}")
-        return result
+        return payload
+
+    async def run_model(self, name: str, texts: List[str]) -> List[Any]:
+        """Run a model on texts, reusing earlier outputs for identical content"""
+        # Outputs depend on the exact model and export, not just the task name
+        prefix = f'inference:{self.model_ids[name]}:{self.model_variant}'
+        keys = [
+            (name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest())
+            for text in texts
+        ]
+        results = [self.inference_cache.get(key) for key in keys]
+        
+        # Identical chunks within a request are looked up and inferred once
+        misses = {}
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                misses.setdefault(key, []).append(i)
+        if not misses:
+            return results
+        
+        if self.redis is not None:
+            try:
+                payloads = await self.redis.mget([f'{prefix}:{digest}' for _, digest in misses])
+                for key, payload in zip(list(misses), payloads):
+                    if payload is not None:
+                        result = self.inference_cache[key] = orjson.loads(payload)
+                        for i in misses.pop(key):
+                            results[i] = result
+            except Exception as e:
+                logger.warning(f"Inference cache lookup failed: {e}")
+        if not misses:
+            return results
+        
+        outputs = await asyncio.gather(
+            *(self.batchers[name].submit(texts[indices[0]]) for indices in misses.values())
+        )
+        
+        fresh = {}
+        for (key, indices), output in zip(misses.items(), outputs):
+            # Round-trip through JSON so cached and fresh results have the same types
+            payload = fresh[key] = orjson.dumps(output, option=orjson.OPT_SERIALIZE_NUMPY)
+            result = self.inference_cache[key] = orjson.loads(payload)
+            for i in indices:
+                results[i] = result
+        
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for (_, digest), payload in fresh.items():
+                        pipe.set(f'{prefix}:{digest}', payload, ex=self.inference_cache_ttl)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Inference cache store failed: {e}")
+        
+        return results
+
+    async def run_model_chunked(self, name: str, chunks: List[tuple]) -> List[tuple]:
+        """Run a model over sentence-aligned (offset, chunk) pairs as one batch"""
+        results = await self.run_model(name, [chunk for _, chunk in chunks])
+        return list(zip(chunks, results))
+
+    def chunk_text(self, text: str, max_tokens: int = 256) -> List[tuple]:
+        """Split text into (offset, chunk) windows of whole sentences up to max_tokens"""
+        doc = sentencizer(text)
+        chunks = []
+        chunk_start = chunk_end = chunk_tokens = 0
+        
+        for sent in doc.sents:
+            # Sentences longer than the window are split on token boundaries
+            for i in range(sent.start, sent.end, max_tokens):
+                piece = doc[i:min(i + max_tokens, sent.end)]
+                if chunk_tokens and chunk_tokens + len(piece) > max_tokens:
+                    chunks.append((chunk_start, text[chunk_start:chunk_end]))
+                    chunk_tokens = 0
+                if not chunk_tokens:
+                    chunk_start = piece.start_char
+                chunk_end = piece.end_char
+                chunk_tokens += len(piece)
+        
+        if chunk_tokens:
+            chunks.append((chunk_start, text[chunk_start:chunk_end]))
+        
+        return chunks
 
     def extract_text_content(self, results: Dict[str, Any]) -> str:
         """Extract meaningful text content from scraping results"""
         text_parts = []
         
-        if isinstance(results, dict):
-            for key, value in results.items():
-                if isinstance(value, str):
-                    text_parts.append(value)
-                elif isinstance(value, list):
-                    for item in value:
-                        if isinstance(item, str):
-                            text_parts.append(item)
-                        elif isinstance(item, dict):
-                            text_parts.append(str(item))
+        # Walk nested results iteratively, keeping only string values in document order
+        stack = [results]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, str):
+                text_parts.append(current)
+            elif isinstance(current, dict):
+                stack.extend(reversed(current.values()))
+            elif isinstance(current, (list, tuple)):
+                stack.extend(reversed(current))
         
         return " ".join(text_parts)
 
-    async def extract_entities(self, text: str) -> List[ExtractedEntity]:
-        """Extract named entities from text using NLP models"""
+    async def extract_entities(self, chunks: List[tuple]) -> List[_Entity]:
+        """Extract named entities from text chunks using NLP models"""
         entities = []
         
-        if not text or not self.models.get('ner'):
+        if not chunks:
             return entities
         
         try:
-            # Use transformer-based NER
-            ner_results = self.models['ner'](text)
+            if self.models.get('ner'):
+                # Use transformer-based NER, shifting chunk offsets back into the full text
+                for (offset, _), ner_results in await self.run_model_chunked('ner', chunks):
+                    for entity in ner_results:
+                        entities.append(_Entity(
+                            type=entity['entity_group'],
+                            value=entity['word'],
+                            confidence=entity['score'],
+                            start=None if entity.get('start') is None else offset + entity['start'],
+                            end=None if entity.get('end') is None else offset + entity['end']
+                        ))
             
-            for entity in ner_results:
-                entities.append(ExtractedEntity(
-                    type=entity['entity_group'],
-                    value=entity['word'],
-                    confidence=entity['score']
-                ))
-            
-            # Use spaCy for additional entity extraction if available
-            if nlp:
-                doc = nlp(text)
-                for ent in doc.ents:
-                    entities.append(ExtractedEntity(
-                        type=ent.label_,
-                        value=ent.text,
-                        confidence=0.8  # Default confidence for spaCy
-                    ))
+            elif nlp:
+                # Fall back to spaCy only when the transformer model is unavailable
+                docs = nlp.pipe((chunk for _, chunk in chunks), batch_size=64)
+                for (offset, _), doc in zip(chunks, docs):
+                    for ent in doc.ents:
+                        entities.append(_Entity(
+                            type=ent.label_,
+                            value=ent.text,
+                            confidence=0.8,  # Default confidence for spaCy
+                            start=offset + ent.start_char,
+                            end=offset + ent.end_char
+                        ))
         
         except Exception as e:
             logger.error(f"Error in entity extraction: {e}")
         
         return entities
 
-    async def analyze_sentiment(self, text: str) -> str:
-        """Analyze sentiment of the text content"""
-        if not text or not self.models.get('sentiment'):
+    async def analyze_sentiment(self, chunks: List[tuple]) -> str:
+        """Analyze sentiment of the text chunks"""
+        if not chunks or not self.models.get('sentiment'):
             return "neutral"
         
         try:
-            sentiment_results = self.models['sentiment'](text)
+            # Average label scores across chunks, weighted by chunk length
+            label_scores = defaultdict(float)
+            for (_, chunk), sentiment_results in await self.run_model_chunked('sentiment', chunks):
+                for result in sentiment_results:
+                    label_scores[result['label']] += result['score'] * len(chunk)
             
             # Get the highest scoring sentiment
-            best_sentiment = max(sentiment_results, key=lambda x: x['score'])
-            return best_sentiment['label'].lower()
+            return max(label_scores, key=label_scores.get).lower()
         
         except Exception as e:
             logger.error(f"Error in sentiment analysis: {e}")
             return "neutral"
 
-    async def classify_threat(self, text: str) -> str:
-        """Classify the threat level of the content"""
-        if not text or not self.models.get('threat_classifier'):
+    async def classify_threat(self, chunks: List[tuple]) -> str:
+        """Classify the threat level of the text chunks"""
+        if not chunks or not self.models.get('threat_classifier'):
             return "unknown"
         
         try:
-            classification_results = self.models['threat_classifier'](text)
+            # The most toxic chunk decides the classification
+            toxic_score = max(
+                (result['score']
+                 for _, classification_results in await self.run_model_chunked('threat_classifier', chunks)
+                 for result in classification_results
+                 if result['label'] == 'TOXIC'),
+                default=0.0
+            )
             
             # Map results to threat classifications
-            if any(result['label'] == 'TOXIC' and result['score'] > 0.7 
-                   for result in classification_results):
+            if toxic_score > 0.7:
                 return "malicious"
-            elif any(result['label'] == 'TOXIC' and result['score'] > 0.3 
-                     for result in classification_results):
+            elif toxic_score > 0.3:
                 return "suspicious"
             else:
                 return "benign"
@@ -247,113 +639,202 @@ class ThreatIntelligenceEngine:
             logger.error(f"Error in threat classification: {e}")
             return "unknown"
 
-    async def extract_iocs(self, text: str) -> List[IndicatorOfCompromise]:
+    def compile_ioc_patterns(self):
+        """Compile IOC patterns once into a multi-pattern matcher"""
+        # id -> IOC type table shared by every matcher backend
+        self.ioc_type_table = list(self.ioc_patterns.keys())
+        self._hs_db = None
+        self._hs_scratch = None
+        self._ioc_regexes = {}
+        
+        hs_ids = []
+        
+        for type_id, (ioc_type, pattern) in enumerate(self.ioc_patterns.items()):
+            if (
+                hyperscan is not None
+                and ioc_type not in self.ioc_regex_only
+                and self.hyperscan_supports(pattern)
+            ):
+                hs_ids.append(type_id)
+            else:
+                # re2 guarantees linear-time matching, unlike stdlib re
+                self._ioc_regexes[type_id] = re2.compile(pattern)
+        
+        if hs_ids:
+            self._hs_db = hyperscan.Database()
+            self._hs_db.compile(
+                expressions=[self.ioc_patterns[self.ioc_type_table[i]].encode() for i in hs_ids],
+                ids=hs_ids,
+                elements=len(hs_ids),
+                flags=[hyperscan.HS_FLAG_SOM_LEFTMOST] * len(hs_ids)
+            )
+            self._hs_scratch = hyperscan.Scratch(self._hs_db)
+
+    def hyperscan_supports(self, pattern: str) -> bool:
+        """Check whether hyperscan can compile a pattern with start-of-match reporting"""
+        try:
+            hyperscan.Database().compile(
+                expressions=[pattern.encode()],
+                ids=[0],
+                elements=1,
+                flags=[hyperscan.HS_FLAG_SOM_LEFTMOST]
+            )
+            return True
+        except hyperscan.error as e:
+            logger.warning(f"Hyperscan rejected IOC pattern {pattern!r}, using regex: {e}")
+            return False
+
+    def scan_iocs(self, text: str) -> List[tuple]:
+        """Return (type_id, start, end, value) for IOC matches, ordered by type then position"""
+        matches = [
+            (type_id, match.start(), match.end(), match.group(0))
+            for type_id, regex in self._ioc_regexes.items()
+            for match in regex.finditer(text)
+        ]
+        
+        if self._hs_db is not None:
+            data = text.encode('utf-8')
+            longest = {}
+            
+            def on_match(type_id, start, end, flags, context):
+                # Hyperscan reports every end offset; keep the longest match per start
+                if end > longest.get((type_id, start), -1):
+                    longest[(type_id, start)] = end
+            
+            self._hs_db.scan(data, match_event_handler=on_match, scratch=self._hs_scratch)
+            
+            # Hyperscan reports byte offsets; map them back to character offsets
+            if text.isascii():
+                char_at = None
+            else:
+                lead_bytes = (np.frombuffer(data, dtype=np.uint8) & 0xC0) != 0x80
+                char_at = np.concatenate(([0], np.cumsum(lead_bytes)))
+            
+            # Drop overlapping matches of the same type, mirroring re.finditer semantics
+            last_end = {}
+            for (type_id, start), end in sorted(longest.items()):
+                if start < last_end.get(type_id, 0):
+                    continue
+                last_end[type_id] = end
+                if char_at is not None:
+                    start, end = int(char_at[start]), int(char_at[end])
+                matches.append((type_id, start, end, text[start:end]))
+        
+        matches.sort(key=lambda m: (m[0], m[1]))
+        return matches
+
+    def drop_contained_matches(self, matches: List[tuple]) -> List[int]:
+        """Map each match to itself, or to the URL/email match it lies inside"""
+        priority = {
+            self.ioc_type_table.index(ioc_type): rank
+            for ioc_type, rank in self.ioc_overlap_priority.items()
+        }
+        
+        # Sweep by start (longest first); every span seen so far starts at or before
+        # the current one, so one that also ends at or after it contains it
+        owner = list(range(len(matches)))
+        furthest = {}  # rank -> index of the match reaching furthest
+        for i in sorted(range(len(matches)), key=lambda i: (matches[i][1], -matches[i][2])):
+            type_id, _, end, _ = matches[i]
+            rank = priority.get(type_id)
+            if rank is None:
+                continue
+            container = next(
+                (j for other, j in furthest.items() if other > rank and matches[j][2] >= end),
+                None
+            )
+            if container is not None:
+                # Containers are visited first, so their own owner is already final
+                owner[i] = owner[container]
+                continue
+            if rank not in furthest or end > matches[furthest[rank]][2]:
+                furthest[rank] = i
+        
+        return owner
+
+    async def extract_iocs(self, text: str) -> List[_IOC]:
         """Extract Indicators of Compromise from text"""
-        import re
         iocs = []
         current_time = datetime.utcnow()
+        current_iso = current_time.isoformat()
+        matches = self.scan_iocs(text)
+        
+        if not matches:
+            return iocs
+        
+        # Check domain reputation (simplified), including domains inside a URL or
+        # email so the signal survives dropping the contained match below
+        domain_type_id = self.ioc_type_table.index('domain')
+        owner = self.drop_contained_matches(matches)
+        suspicious_rows = set()
+        for i, match in enumerate(matches):
+            if match[0] == domain_type_id and any(tld in match[3] for tld in self.suspicious_tlds):
+                suspicious_rows.add(owner[i])
+        
+        kept = [i for i in range(len(matches)) if owner[i] == i]
+        suspicious = np.fromiter((i in suspicious_rows for i in kept), dtype=np.bool_, count=len(kept))
+        matches = [matches[i] for i in kept]
+        
+        # Lay the matches out as arrays for the compiled scoring kernel
+        ip_type_id = self.ioc_type_table.index('ip')
+        type_ids = np.fromiter((match[0] for match in matches), dtype=np.uint8, count=len(matches))
+        
+        ip_rows = np.flatnonzero(type_ids == ip_type_id)
+        ip_addrs = np.zeros(len(matches), dtype=np.uint32)
+        ip_valid = np.zeros(len(matches), dtype=np.bool_)
+        ip_addrs[ip_rows], ip_valid[ip_rows] = self.ip_to_uint32([matches[i][3] for i in ip_rows])
+        
+        confidence = score_iocs(
+            type_ids, ip_addrs, ip_valid, suspicious, self.ioc_confidence_table, ip_type_id
+        )
         
-        for ioc_type, pattern in self.ioc_patterns.items():
-            matches = re.findall(pattern, text)
-            
-            for match in matches:
-                # Basic validation and scoring
-                confidence = self.calculate_ioc_confidence(ioc_type, match)
-                threat_type = self.determine_threat_type(ioc_type, match)
-                
-                if confidence > 0.5:  # Only include high-confidence IOCs
-                    ioc = IndicatorOfCompromise(
-                        type=ioc_type,
-                        value=match,
-                        confidence=confidence,
-                        threat_type=threat_type,
-                        first_seen=current_time,
-                        last_seen=current_time
-                    )
-                    iocs.append(ioc)
+        # Only include high-confidence IOCs
+        for i in np.flatnonzero(confidence > 0.5):
+            ioc_type = self.ioc_type_table[matches[i][0]]
+            iocs.append(_IOC(
+                type=ioc_type,
+                value=matches[i][3],
+                confidence=float(confidence[i]),
+                threat_type=self.ioc_threat_types.get(ioc_type, 'unknown'),
+                first_seen=current_time,
+                last_seen=current_time,
+                seen_iso=current_iso
+            ))
         
         return iocs
 
-    def calculate_ioc_confidence(self, ioc_type: str, value: str) -> float:
-        """Calculate confidence score for an IOC"""
-        # Basic confidence scoring logic
-        base_confidence = 0.7
-        
-        # Adjust based on IOC type
-        if ioc_type in ['hash_md5', 'hash_sha1', 'hash_sha256']:
-            return 0.95  # High confidence for hashes
-        elif ioc_type == 'cve':
-            return 0.9   # High confidence for CVEs
-        elif ioc_type == 'ip':
-            # Check if it's a private IP
-            if self.is_private_ip(value):
-                return 0.3
-            return 0.8
-        elif ioc_type == 'domain':
-            # Check domain reputation (simplified)
-            if any(tld in value for tld in ['.tk', '.ml', '.ga']):
-                return 0.9  # Suspicious TLDs
-            return base_confidence
-        
-        return base_confidence
-
-    def is_private_ip(self, ip: str) -> bool:
-        """Check if IP is in private range"""
-        parts = ip.split('.')
-        if len(parts) != 4:
-            return False
-        
-        try:
-            first_octet = int(parts[0])
-            second_octet = int(parts[1])
-            
-            # Private IP ranges
-            if first_octet == 10:
-                return True
-            elif first_octet == 172 and 16 <= second_octet <= 31:
-                return True
-            elif first_octet == 192 and second_octet == 168:
-                return True
-            elif ip.startswith('127.'):
-                return True
-            
-            return False
-        except ValueError:
-            return False
+    def ip_to_uint32(self, ips: List[str]) -> tuple:
+        """Pack dotted-quad IPs into uint32 values, with a mask of which are valid addresses"""
+        if not ips:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.bool_)
+        
+        octets = np.array([ip.split('.') for ip in ips]).astype(np.uint32)
+        valid = (octets <= 255).all(axis=1)
+        packed = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+        return np.where(valid, packed, 0).astype(np.uint32), valid
 
-    def determine_threat_type(self, ioc_type: str, value: str) -> str:
-        """Determine the threat type based on IOC characteristics"""
-        threat_type_mapping = {
-            'hash_md5': 'malware',
-            'hash_sha1': 'malware',
-            'hash_sha256': 'malware',
-            'ip': 'network',
-            'domain': 'network',
-            'url': 'network',
-            'email': 'phishing',
-            'cve': 'vulnerability'
-        }
-        
-        return threat_type_mapping.get(ioc_type, 'unknown')
+    def match_signatures(self, text_lower: str) -> tuple:
+        """Find campaign signatures and threat keywords in one pass over lowercased text"""
+        campaigns = set()
+        keywords = set()
+        
+        for _, tags in self._signature_ac.iter(text_lower):
+            for kind, value in tags:
+                if kind == 'campaign':
+                    campaigns.add(value)
+                else:
+                    keywords.add(value)
+        
+        return campaigns, keywords
 
-    async def assess_threat_level(self, text: str, entities: List[ExtractedEntity], 
-                                  iocs: List[IndicatorOfCompromise]) -> str:
+    async def assess_threat_level(self, keyword_matches: set, entities: List[_Entity], 
+                                  iocs: List[_IOC]) -> str:
         """Assess overall threat level based on multiple factors"""
         score = 0
         
-        # Score based on threat keywords
-        text_lower = text.lower()
-        for level, keywords in self.threat_keywords.items():
-            for keyword in keywords:
-                if keyword in text_lower:
-                    if level == 'critical':
-                        score += 10
-                    elif level == 'high':
-                        score += 7
-                    elif level == 'medium':
-                        score += 4
-                    elif level == 'low':
-                        score += 1
+        # Score based on threat keywords (each distinct keyword counts once)
+        for level, _ in keyword_matches:
+            score += self.threat_keyword_scores[level]
         
         # Score based on IOCs
         for ioc in iocs:
@@ -381,61 +862,67 @@ class ThreatIntelligenceEngine:
         else:
             return "info"
 
-    async def identify_campaigns(self, text: str, entities: List[ExtractedEntity]) -> List[str]:
+    async def identify_campaigns(self, campaign_matches: set, entities: List[_Entity]) -> List[str]:
         """Identify related threat campaigns"""
-        campaigns = []
-        text_lower = text.lower()
+        matched = set(campaign_matches)
         
-        # Check campaign signatures
-        for campaign, signatures in self.campaign_signatures.items():
-            for signature in signatures:
-                if signature.lower() in text_lower:
-                    campaigns.append(campaign)
-                    break
-        
-        # Check entities for campaign indicators
-        for entity in entities:
-            entity_value_lower = entity.value.lower()
-            for campaign, signatures in self.campaign_signatures.items():
-                if any(sig in entity_value_lower for sig in signatures):
-                    if campaign not in campaigns:
-                        campaigns.append(campaign)
+        # Check entities for campaign indicators; no signature spans the separator
+        entity_text = "\n".join(entity.value.lower() for entity in entities)
+        matched.update(self.match_signatures(entity_text)[0])
         
-        return campaigns
+        return [campaign for campaign in self.campaign_signatures if campaign in matched]
 
-    async def store_analysis_results(self, job_id: str, result: AIAnalysisResult):
+    async def store_analysis_results(self, job_id: str, payload: bytes, iocs: List[_IOC]):
         """Store analysis results for future correlation"""
         try:
-            # Store in Redis for quick access
-            redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-            
-            # Store full results
-            await redis_client.hset(
-                'ai_analysis_results',
-                job_id,
-                json.dumps(result.dict(), default=str)
-            )
-            
-            # Store IOCs separately for correlation
-            for ioc in result.iocs:
-                await redis_client.sadd(f'ioc:{ioc.type}', ioc.value)
-                await redis_client.hset(
-                    f'ioc_details:{ioc.value}',
-                    'first_seen', ioc.first_seen.isoformat(),
-                    'last_seen', ioc.last_seen.isoformat(),
-                    'confidence', str(ioc.confidence),
-                    'threat_type', ioc.threat_type
-                )
-            
-            await redis_client.close()
+            # Queue every write and ship them to Redis in a single round-trip
+            async with self.redis.pipeline(transaction=False) as pipe:
+                # Store full results
+                pipe.hset('ai_analysis_results', job_id, payload)
+                
+                # Store IOCs separately for correlation
+                for ioc in iocs:
+                    pipe.sadd(f'ioc:{ioc.type}', ioc.value)
+                    pipe.hset(f'ioc_details:{ioc.value}', mapping={
+                        'first_seen': ioc.seen_iso,
+                        'last_seen': ioc.seen_iso,
+                        'confidence': str(ioc.confidence),
+                        'threat_type': ioc.threat_type
+                    })
+                
+                await pipe.execute()
             
         except Exception as e:
             logger.error(f"Error storing analysis results: {e}")
 
 # FastAPI app setup
-app = FastAPI(title="OSINT AI/NLP Service", version="1.0.0")
+app = FastAPI(
+    title="OSINT AI/NLP Service",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 threat_engine = ThreatIntelligenceEngine()
 
+@app.on_event("startup")
+async def startup():
+    # One pooled client for the whole process instead of a connection per request
+    try:
+        app.state.redis = redis.from_url(
+            os.getenv('REDIS_URL', 'redis://localhost:6379'),
+            max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '64')),
+            decode_responses=False
+        )
+    except ValueError as e:
+        # Serve analyses without persistence rather than refusing to boot
+        logger.error(f"Invalid REDIS_URL, running without Redis: {e}")
+        app.state.redis = None
+    threat_engine.redis = app.state.redis
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.redis is not None:
+        await app.state.redis.close()
+
 @app.get("/health")
 async def health_check():
     return {
@@ -449,11 +936,13 @@ async def health_check():
 async def readiness_check():
     return {"status": "ready"}
 
-@app.post("/analyze", response_model=AIAnalysisResult)
+# The engine returns pre-serialized JSON, so skip response_model re-validation
+# and re-encoding; the model is still advertised in the OpenAPI schema
+@app.post("/analyze", responses={200: {"model": AIAnalysisResult}})
 async def analyze_content(request: AnalysisRequest):
     try:
-        result = await threat_engine.analyze_content(request)
-        return result
+        payload = await threat_engine.analyze_content(request)
+        return Response(content=payload, media_type="application/json")
     except Exception as e:
         logger.error(f"Error in analysis: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -462,9 +951,7 @@ async def analyze_content(request: AnalysisRequest):
 async def get_iocs_by_type(ioc_type: str):
     """Get stored IOCs by type"""
     try:
-        redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-        iocs = await redis_client.smembers(f'ioc:{ioc_type}')
-        await redis_client.close()
+        iocs = await app.state.redis.smembers(f'ioc:{ioc_type}')
         
         return {"ioc_type": ioc_type, "iocs": list(iocs)}
     except Exception as e:
@@ -479,25 +966,41 @@ async def get_known_campaigns():
 async def correlate_indicators(ioc_values: List[str]):
     """Correlate indicators across stored analysis results"""
     try:
-        redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+        async with app.state.redis.pipeline(transaction=False) as pipe:
+            for ioc_value in ioc_values:
+                pipe.hgetall(f'ioc_details:{ioc_value}')
+            all_details = await pipe.execute()
         
         correlations = {}
-        for ioc_value in ioc_values:
-            details = await redis_client.hgetall(f'ioc_details:{ioc_value}')
+        for ioc_value, details in zip(ioc_values, all_details):
             if details:
                 correlations[ioc_value] = details
         
-        await redis_client.close()
         return {"correlations": correlations}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    # CPUs this process may be scheduled on (cpuset/taskset); CFS quotas such as
+    # docker --cpus or k8s limits.cpu don't shrink this, so deployments set WORKERS.
+    # sched_getaffinity is Linux-only, so other platforms count every CPU
+    sched_getaffinity = getattr(os, "sched_getaffinity", None)
+    cpus = len(sched_getaffinity(0)) if sched_getaffinity else os.cpu_count() or 1
+    workers = int(os.getenv("WORKERS", str(cpus)))
+    
+    # Each GPU worker would hold its own CUDA context and model copies; a single
+    # process keeps the device busy through the micro-batchers instead
+    if threat_engine.use_gpu and workers > 1:
+        logger.info(f"GPU inference enabled, running 1 worker instead of {workers}")
+        workers = 1
+    
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8082,
-        workers=int(os.getenv("WORKERS", "1")),
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
         reload=False
     )